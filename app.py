@@ -3,13 +3,20 @@ import time
 import os
 import logging
 import threading
+import hmac
+import json
+import re
 from datetime import datetime
 from flask import Flask, Response, request, send_from_directory, jsonify, g, render_template, abort
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
-from queue import Queue
 import numpy as np
 
+try:
+    import orjson  # Optional: faster JSON serialization for /get_anomalies
+except ImportError:
+    orjson = None
+
 ###############################################################################
 # Configuration
 ###############################################################################
@@ -18,6 +25,7 @@ ANOMALY_STORAGE_DIR = 'anomalies'       # Directory to store anomaly photos
 VIDEO_DURATION = 30 * 60                # Duration of each video chunk (30 minutes)
 MAX_VIDEO_DURATION = 12 * 60 * 60       # Keep recordings for 12 hours
 MAX_ANOMALY_IMAGES = 2000               # Keep up to 2000 anomaly images
+VIDEO_SLOTS = MAX_VIDEO_DURATION // VIDEO_DURATION  # Video files reused in rotation (24)
 FRAME_WIDTH = 640                       # Width of the video frame
 FRAME_HEIGHT = 480                      # Height of the video frame
 FPS = 10                                # Frames per second for recording and streaming
@@ -29,9 +37,23 @@ USERS = {
 }
 CAMERA_INDEX = 0                        # Usually 0 for USB camera
 VAR_THRESHOLD = 50                      # Anomaly detection sensitivity
-CONTOUR_AREA_THRESHOLD = 20000          # Min area to consider an anomaly
+CONTOUR_AREA_THRESHOLD = 20000          # Min contour area to consider an anomaly (full-resolution pixels)
+DETECTION_SCALE = 2                     # Downscale factor applied before motion detection
+USE_CUDA = True                         # Run background subtraction on a CUDA GPU when available
 ANOMALY_COOLDOWN = 5.0                  # Wait 5 seconds after capturing an anomaly
 LOG_LEVEL = logging.INFO                # Logging level (DEBUG, INFO, WARNING, etc.)
+GAMMA = 1.5                             # Gamma correction applied to night-time frames
+ENHANCE_MAX_BRIGHTNESS = 140            # Skip night enhancement when mean brightness is above this
+JPEG_QUALITY = 80                       # JPEG quality for the MJPEG stream (0-100)
+
+###############################################################################
+# Precomputed Tables & Encoder Parameters
+###############################################################################
+# Gamma lookup table, built once since GAMMA is constant
+_GAMMA_LUT = np.clip(((np.arange(256) / 255.0) ** GAMMA) * 255.0, 0, 255).astype(np.uint8)
+
+# Stream encoding: lower quality and skip Huffman table optimization to cut encode time
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
 
 ###############################################################################
 # Logging Setup
@@ -51,22 +73,38 @@ auth = HTTPBasicAuth()
 # Hard-coded user dictionary
 users = USERS
 
+# Keyed HMAC-SHA256 digest of the last password verified for each user. The slow
+# check_password_hash() then only runs on a user's first request (or a wrong
+# password), not on every stream chunk and thumbnail fetch. The per-process random
+# key keeps the cached digests from being brute-forced like a bare hash.
+_CACHE_KEY = os.urandom(32)
+_verified_digests = {}
+
 @auth.verify_password
 def verify_password(username, password):
-    if username in users and check_password_hash(users.get(username), password):
-        g.user = username  # Store the username in Flask's g context
-        return username
-    return None
+    if username not in users:
+        return None
+    digest = hmac.new(_CACHE_KEY, (password or "").encode(), 'sha256').digest()
+    cached = _verified_digests.get(username)
+    if cached is None or not hmac.compare_digest(cached, digest):
+        if not check_password_hash(users.get(username), password):
+            return None
+        _verified_digests[username] = digest
+    g.user = username  # Store the username in Flask's g context
+    return username
 
 ###############################################################################
-# Shared Camera Class with Frame Queue
+# Shared Camera Class with Latest-Frame Buffer
 ###############################################################################
 class SharedCamera:
     """
     A shared camera class that continuously captures frames in a dedicated thread.
-    Uses a queue to distribute frames to different consumers without blocking.
+    Each frame is passed to the registered frame handlers (recording, anomaly
+    detection) in the same loop. While stream clients are connected, each frame is
+    also enhanced and JPEG-encoded once here and the latest encoding is shared by all
+    of them.
     """
-    def __init__(self, camera_index=0, queue_size=10):
+    def __init__(self, camera_index=0):
         self.cap = cv2.VideoCapture(camera_index)
         if not self.cap.isOpened():
             logging.critical(f"Cannot open camera at index {camera_index}. Exiting.")
@@ -77,7 +115,11 @@ class SharedCamera:
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
         self.cap.set(cv2.CAP_PROP_FPS, FPS)
 
-        self.frame_queue = Queue(maxsize=queue_size)
+        self._jpeg = None
+        self._seq = 0
+        self._stream_clients = 0
+        self._frame_handlers = []
+        self._cv = threading.Condition()
         self.running = True
         self.thread = threading.Thread(target=self.update, daemon=True)
         self.thread.start()
@@ -86,7 +128,8 @@ class SharedCamera:
 
     def update(self):
         """
-        Continuously read frames from the camera and put them into the queue.
+        Continuously read frames from the camera, publish the latest encoded frame
+        and run the frame handlers.
         """
         while self.running:
             ret, frame = self.cap.read()
@@ -94,22 +137,71 @@ class SharedCamera:
                 logging.warning("Failed to read frame from camera.")
                 time.sleep(0.1)
                 continue
-            if not self.frame_queue.full():
-                self.frame_queue.put(frame)
-            else:
-                # If the queue is full, discard the oldest frame
-                self.frame_queue.get()
-                self.frame_queue.put(frame)
+            jpeg = None
+            if self._stream_clients:
+                try:
+                    jpeg = self._encode(frame)
+                except Exception:
+                    logging.exception("Failed to encode frame for streaming.")
+            with self._cv:
+                self._jpeg = jpeg
+                self._seq += 1
+                self._cv.notify_all()
+                handlers = tuple(self._frame_handlers)
+
+            for handler in handlers:
+                try:
+                    handler(frame)
+                except Exception:
+                    logging.exception("Frame handler failed.")
         self.cap.release()
         logging.info("Camera capture thread stopped.")
 
-    def get_frame(self):
+    def get_jpeg(self, last_seen_seq=0, timeout=1.0):
         """
-        Get the latest frame from the queue without blocking.
+        Wait for an encoded frame newer than `last_seen_seq` and return (seq, jpeg_bytes).
+        Returns (last_seen_seq, None) if none arrives within `timeout` seconds.
         """
-        if not self.frame_queue.empty():
-            return self.frame_queue.get()
-        return None
+        with self._cv:
+            ready = lambda: self._seq > last_seen_seq and self._jpeg is not None
+            if not self._cv.wait_for(ready, timeout=timeout):
+                return last_seen_seq, None
+            return self._seq, self._jpeg
+
+    def add_frame_handler(self, handler):
+        """
+        Register a callable to be run on every captured frame in the capture thread.
+        """
+        with self._cv:
+            self._frame_handlers.append(handler)
+
+    def add_stream_client(self):
+        """
+        Register an MJPEG client so the capture thread starts encoding frames.
+        """
+        with self._cv:
+            self._stream_clients += 1
+
+    def remove_stream_client(self):
+        """
+        Unregister an MJPEG client; encoding stops when none are left.
+        """
+        with self._cv:
+            self._stream_clients -= 1
+
+    def _encode(self, frame):
+        """
+        Enhance the frame during night time (9 PM to 5 AM) and encode it as JPEG bytes.
+        """
+        if is_night_time():
+            logging.debug("Night time detected. Enhancing frame for better visibility.")
+            frame = enhance_frame(frame)
+
+        ret, buffer = cv2.imencode('.jpg', frame, _JPEG_PARAMS)
+        if not ret:
+            logging.warning("Failed to encode frame to JPEG.")
+            return None
+        return buffer.tobytes()
 
     def stop(self):
         """
@@ -127,72 +219,115 @@ camera = SharedCamera(camera_index=CAMERA_INDEX)
 ###############################################################################
 # Helper Functions
 ###############################################################################
-def manage_storage():
+# Storage is a fixed set of slots reused in rotation, so old files are simply
+# overwritten and nothing has to be listed, parsed or deleted:
+#   videos/video_00.mp4 ... video_{VIDEO_SLOTS - 1}.mp4
+#   anomalies/anomaly_0000.jpg ... with an anomaly_NNNN.json sidecar holding the capture time
+# After a restart, writing resumes after the most recently modified slot, so the
+# oldest file is overwritten first and never the one written just before.
+_VIDEO_FILENAME_RE = re.compile(r"^video_(\d{2})\.mp4$")
+_ANOMALY_FILENAME_RE = re.compile(r"^anomaly_(\d{4})\.jpg$")
+# Files from the earlier timestamped naming scheme, removed during ring recovery
+_LEGACY_VIDEO_FILENAME_RE = re.compile(r"^video_\d{8}_\d{6}\.mp4$")
+_LEGACY_ANOMALY_FILENAME_RE = re.compile(r"^anomaly_\d{8}_\d{6}\.jpg$")
+
+# Anomaly ring state: the next slot to write, how many slots hold a photo and the
+# formatted capture time per slot. Recovered from disk once (the sidecars are only
+# read then), then updated in memory as photos are saved.
+_anomaly_ring = {"loaded": False, "next": 0, "count": 0, "timestamps": [None] * MAX_ANOMALY_IMAGES}
+_anomaly_ring_lock = threading.Lock()
+
+def scan_ring_slots(directory, filename_re, num_slots, legacy_re=None):
     """
-    1) Deletes video files older than MAX_VIDEO_DURATION (12 hours).
-    2) Ensures we don't store more than MAX_ANOMALY_IMAGES (2000).
-    3) Also ensures anomaly photos older than MAX_VIDEO_DURATION get removed.
+    Return {slot: mtime} for the ring files in `directory` matching `filename_re`.
+    Files matching `legacy_re` (the old timestamped names) are deleted along the way,
+    since the ring never overwrites them.
     """
-    now = time.time()
-    cutoff = now - MAX_VIDEO_DURATION
-
-    # Ensure directories exist
-    os.makedirs(VIDEO_STORAGE_DIR, exist_ok=True)
-    os.makedirs(ANOMALY_STORAGE_DIR, exist_ok=True)
-
-    # Manage video files by time
-    for filename in os.listdir(VIDEO_STORAGE_DIR):
-        if filename.startswith("video_") and filename.endswith(".mp4"):
-            filepath = os.path.join(VIDEO_STORAGE_DIR, filename)
-            timestamp_str = filename.replace("video_", "").replace(".mp4", "")
-            try:
-                file_time = time.mktime(datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S").timetuple())
-                if file_time < cutoff:
-                    os.remove(filepath)
-                    logging.info(f"Deleted old video file: {filepath}")
-            except Exception as e:
-                logging.error(f"Error parsing video filename '{filename}': {e}")
-
-    # Manage anomaly files by time and count
-    anomaly_files = []
-    for filename in os.listdir(ANOMALY_STORAGE_DIR):
-        if filename.startswith("anomaly_") and filename.endswith(".jpg"):
-            filepath = os.path.join(ANOMALY_STORAGE_DIR, filename)
-            anomaly_files.append(filepath)
-
-    # Sort anomaly files by creation time (based on filename)
-    def extract_time(fpath):
-        base = os.path.basename(fpath)
-        time_str = base.replace("anomaly_", "").replace(".jpg", "")
-        try:
-            return datetime.strptime(time_str, "%Y%m%d_%H%M%S")
-        except:
-            return datetime.now()  # fallback if parse fails
-
-    anomaly_files.sort(key=lambda x: extract_time(x), reverse=True)  # Latest first
+    slots = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = filename_re.match(entry.name)
+            if match is not None and int(match.group(1)) < num_slots:
+                slots[int(match.group(1))] = entry.stat().st_mtime
+            elif legacy_re is not None and legacy_re.match(entry.name):
+                try:
+                    os.remove(entry.path)
+                    logging.info(f"Deleted legacy-named file: {entry.path}")
+                except OSError as e:
+                    logging.error(f"Error deleting legacy-named file '{entry.path}': {e}")
+    return slots
+
+def next_ring_slot(slots, num_slots):
+    """
+    Return the slot after the most recently modified one (0 for an empty ring).
+    """
+    if not slots:
+        return 0
+    return (max(slots, key=slots.get) + 1) % num_slots
 
-    # Delete anomalies older than cutoff
-    for filepath in anomaly_files:
-        base = os.path.basename(filepath)
-        timestamp_str = base.replace("anomaly_", "").replace(".jpg", "")
+def _load_anomaly_ring():
+    """
+    Recover the anomaly ring position from the existing photos on first use:
+    writing resumes after the most recently modified slot.
+    Must be called with _anomaly_ring_lock held.
+    """
+    if _anomaly_ring["loaded"]:
+        return
+    slots = scan_ring_slots(ANOMALY_STORAGE_DIR, _ANOMALY_FILENAME_RE, MAX_ANOMALY_IMAGES,
+                            legacy_re=_LEGACY_ANOMALY_FILENAME_RE)
+    timestamps = _anomaly_ring["timestamps"]
+    for slot, mtime in slots.items():
+        sidecar = os.path.join(ANOMALY_STORAGE_DIR, f"anomaly_{slot:04d}.json")
         try:
-            file_time = time.mktime(datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S").timetuple())
-            if file_time < cutoff:
-                os.remove(filepath)
-                logging.info(f"Deleted old anomaly file: {filepath}")
-        except Exception as e:
-            logging.error(f"Error parsing anomaly filename '{base}': {e}")
-
-    # If more than MAX_ANOMALY_IMAGES remain, remove oldest
-    anomaly_files = [os.path.join(ANOMALY_STORAGE_DIR, f) for f in os.listdir(ANOMALY_STORAGE_DIR)
-                     if f.startswith("anomaly_") and f.endswith(".jpg")]
-    if len(anomaly_files) > MAX_ANOMALY_IMAGES:
-        # Sort again (latest first)
-        anomaly_files.sort(key=lambda x: extract_time(x), reverse=True)
-        excess = len(anomaly_files) - MAX_ANOMALY_IMAGES
-        for i in range(excess):
-            os.remove(anomaly_files[-1])  # Remove the oldest
-            logging.info(f"Deleted anomaly file to maintain max count: {anomaly_files[-1]}")
+            with open(sidecar) as f:
+                timestamps[slot] = json.load(f)["timestamp"]
+        except (OSError, ValueError, KeyError):
+            # Missing or unreadable sidecar: fall back to the photo's modification time
+            timestamps[slot] = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
+    _anomaly_ring["next"] = next_ring_slot(slots, MAX_ANOMALY_IMAGES)
+    _anomaly_ring["count"] = len(slots)
+    _anomaly_ring["loaded"] = True
+
+def save_anomaly(frame, now):
+    """
+    Write an anomaly photo and its timestamp sidecar into the next ring slot,
+    overwriting the oldest photo once the ring is full. Returns the photo path.
+    """
+    with _anomaly_ring_lock:
+        _load_anomaly_ring()
+        slot = _anomaly_ring["next"]
+        filepath = os.path.join(ANOMALY_STORAGE_DIR, f"anomaly_{slot:04d}.jpg")
+        formatted_time = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+        cv2.imwrite(filepath, frame)
+        with open(os.path.join(ANOMALY_STORAGE_DIR, f"anomaly_{slot:04d}.json"), "w") as f:
+            json.dump({"timestamp": formatted_time}, f)
+        _anomaly_ring["timestamps"][slot] = formatted_time
+        _anomaly_ring["next"] = (slot + 1) % MAX_ANOMALY_IMAGES
+        _anomaly_ring["count"] = min(_anomaly_ring["count"] + 1, MAX_ANOMALY_IMAGES)
+    return filepath
+
+def list_anomaly_files(start, end):
+    """
+    Return (filename, formatted_time) for positions [start, end) of the newest-first order.
+    """
+    with _anomaly_ring_lock:
+        _load_anomaly_ring()
+        newest = _anomaly_ring["next"] - 1
+        end = min(end, _anomaly_ring["count"])
+        slots = [(newest - i) % MAX_ANOMALY_IMAGES for i in range(max(start, 0), end)]
+        return [(f"anomaly_{slot:04d}.jpg", _anomaly_ring["timestamps"][slot] or "Unknown")
+                for slot in slots]
+
+def read_anomaly_timestamp(filename):
+    """
+    Return the formatted capture time of an anomaly photo, or "Unknown".
+    """
+    match = _ANOMALY_FILENAME_RE.match(filename)
+    if match is None or int(match.group(1)) >= MAX_ANOMALY_IMAGES:
+        return "Unknown"
+    with _anomaly_ring_lock:
+        _load_anomaly_ring()
+        return _anomaly_ring["timestamps"][int(match.group(1))] or "Unknown"
 
 def is_night_time():
     """
@@ -206,36 +341,64 @@ def is_night_time():
         return True
     return False
 
+def equalize_lut(y):
+    """
+    Build the 256-entry histogram equalization lookup table for a luminance channel.
+    Same mapping as cv2.equalizeHist, but returned as a LUT so it can be composed
+    with other per-pixel lookups before touching the frame.
+    """
+    hist = cv2.calcHist([y], [0], None, [256], [0, 256]).ravel()
+    cdf = hist.cumsum()
+    cdf_min = cdf[np.nonzero(cdf)[0][0]]
+    total = cdf[-1]
+    if total == cdf_min:
+        # Single-valued channel, equalization is a no-op
+        return np.arange(256, dtype=np.uint8)
+    lut = np.round((cdf - cdf_min) * 255.0 / (total - cdf_min))
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+def _remap_luma_yuv(frame):
+    """
+    Equalize and gamma-correct the luminance of a BGR frame via a YUV round trip.
+    """
+    # Convert to YUV color space to work on the luminance channel only
+    yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
+    y = yuv[:, :, 0]
+
+    # Histogram equalization and gamma correction fused into one Y-channel lookup
+    fused_lut = _GAMMA_LUT[equalize_lut(y)]
+    yuv[:, :, 0] = cv2.LUT(y, fused_lut)
+
+    # Convert back to BGR color space
+    return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR)
+
+def overlay_time(frame):
+    """
+    Draw the current time in the bottom-left corner of the frame (in place).
+    """
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cv2.putText(frame, current_time, (10, FRAME_HEIGHT - 10),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+    return frame
+
 def enhance_frame(frame):
     """
     Enhance the frame for low-light conditions using histogram equalization,
     gamma correction, and noise reduction. Optionally overlay the current time.
+    Frames that are already well lit skip enhancement but still get the time overlay.
     """
-    # Convert to YUV color space to apply histogram equalization on the luminance channel
-    yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
-    
-    # Histogram Equalization on the Y channel
-    yuv[:, :, 0] = cv2.equalizeHist(yuv[:, :, 0])
-    
-    # Convert back to BGR color space
-    equalized = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR)
-    
-    # Gamma Correction
-    gamma = 1.5  # Adjust gamma value as needed
-    look_up_table = np.empty((1, 256), dtype='uint8')
-    for i in range(256):
-        look_up_table[0, i] = np.clip(pow(i / 255.0, gamma) * 255.0, 0, 255)
-    gamma_corrected = cv2.LUT(equalized, look_up_table)
+    # Cheap brightness estimate from a sparse pixel grid
+    if frame[::16, ::16].mean() > ENHANCE_MAX_BRIGHTNESS:
+        # Copy first: `frame` is shared with the recorder and detector
+        return overlay_time(frame.copy())
+
+    gamma_corrected = _remap_luma_yuv(frame)
     
     # Noise Reduction using Gaussian Blur
     denoised = cv2.GaussianBlur(gamma_corrected, (5, 5), 0)
     
     # Overlay current time (optional)
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cv2.putText(denoised, current_time, (10, FRAME_HEIGHT - 10),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
-    
-    return denoised
+    return overlay_time(denoised)
 
 ###############################################################################
 # Flask Routes
@@ -300,25 +463,14 @@ def get_anomalies():
     page = request.args.get('page', default=1, type=int)
     per_page = request.args.get('per_page', default=20, type=int)
 
-    # Get list of anomaly images sorted by newest first
-    anomaly_files = [f for f in os.listdir(ANOMALY_STORAGE_DIR) if f.startswith("anomaly_") and f.endswith(".jpg")]
-    anomaly_files.sort(reverse=True)  # Latest first
-
-    # Pagination
+    # Pagination over anomaly images sorted by newest first
     start = (page - 1) * per_page
     end = start + per_page
-    paginated_files = anomaly_files[start:end]
+    paginated_files = list_anomaly_files(start, end)
 
-    # Generate URLs and extract timestamps
+    # Generate URLs
     images = []
-    for filename in paginated_files:
-        file_path = os.path.join(ANOMALY_STORAGE_DIR, filename)
-        timestamp_str = filename.replace("anomaly_", "").replace(".jpg", "")
-        try:
-            timestamp = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-            formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        except:
-            formatted_time = "Unknown"
+    for filename, formatted_time in paginated_files:
         images.append({
             'url': f'/anomalies/{filename}',
             'filename': filename,
@@ -326,6 +478,8 @@ def get_anomalies():
         })
 
     logging.info(f"Client '{username}' fetched anomalies: page {page}, per_page {per_page}")
+    if orjson is not None:
+        return app.response_class(orjson.dumps({'images': images}), mimetype='application/json')
     return jsonify({'images': images})
 
 @app.route('/anomaly/<filename>')
@@ -338,17 +492,12 @@ def anomaly_detail(filename):
     logging.info(f"Client '{username}' requested anomaly detail for: {filename}")
     
     # Validate filename
-    if not (filename.startswith("anomaly_") and filename.endswith(".jpg")):
+    if not _ANOMALY_FILENAME_RE.match(filename):
         logging.warning(f"Invalid anomaly filename requested: {filename}")
         abort(404)
     
-    # Extract timestamp
-    timestamp_str = filename.replace("anomaly_", "").replace(".jpg", "")
-    try:
-        timestamp = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-        formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-    except:
-        formatted_time = "Unknown"
+    # Read timestamp from the sidecar
+    formatted_time = read_anomaly_timestamp(filename)
     
     file_path = os.path.join(ANOMALY_STORAGE_DIR, filename)
     if not os.path.exists(file_path):
@@ -363,132 +512,146 @@ def anomaly_detail(filename):
 def generate_frames():
     """
     Generator function that yields JPEG frames from the shared camera.
-    Enhances frames during night time (9 PM to 5 AM).
+    Frames are encoded once in the capture thread and shared by every client.
     """
-    while True:
-        frame = camera.get_frame()
-        if frame is None:
-            logging.debug("No frame available yet, waiting...")
-            time.sleep(0.05)
-            continue
-
-        # Check if it's night time
-        if is_night_time():
-            logging.debug("Night time detected. Enhancing frame for better visibility.")
-            enhanced = enhance_frame(frame)
-        else:
-            enhanced = frame
-
-        # Encode frame as JPEG
-        ret, buffer = cv2.imencode('.jpg', enhanced)
-        if not ret:
-            logging.warning("Failed to encode frame to JPEG.")
-            continue
+    camera.add_stream_client()
+    try:
+        seq = 0
+        while True:
+            seq, jpeg = camera.get_jpeg(seq)
+            if jpeg is None:
+                logging.debug("No frame available yet, waiting...")
+                continue
 
-        # Yield the frame in byte format
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+            # Yield the frame in byte format
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+    finally:
+        camera.remove_stream_client()
 
 ###############################################################################
-# Video Recording Thread
+# Video Recorder
 ###############################################################################
-def record_video():
+class VideoRecorder:
     """
-    Continuously record the camera feed in chunks (default 30 mins), saving MP4 files
-    and managing storage to keep only 12 hours of content.
+    Records the camera feed in chunks (default 30 mins) into a rotating set of
+    VIDEO_SLOTS MP4 files, so only the last 12 hours of content are kept.
+    Called by the capture thread for every frame, so each frame is written exactly once.
     """
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = None
-    end_time = time.time() + VIDEO_DURATION
-
-    logging.info("Video recording thread started.")
-
-    while True:
-        frame = camera.get_frame()
-        if frame is None:
-            logging.debug("No frame available for recording.")
-            time.sleep(0.05)
-            continue
-
-        if video_writer is None:
-            # Start a new video file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            video_filename = os.path.join(VIDEO_STORAGE_DIR, f"video_{timestamp}.mp4")
+    def __init__(self):
+        self.fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.video_writer = None
+        self.end_time = 0
+        # Resume after the newest chunk so a restart never truncates recent footage
+        slots = scan_ring_slots(VIDEO_STORAGE_DIR, _VIDEO_FILENAME_RE, VIDEO_SLOTS,
+                                legacy_re=_LEGACY_VIDEO_FILENAME_RE)
+        self.next_slot = next_ring_slot(slots, VIDEO_SLOTS)
+
+    def write(self, frame):
+        """
+        Write a frame to the current chunk, moving to the next slot after VIDEO_DURATION.
+        """
+        if self.video_writer is None:
+            # Start (or overwrite) the oldest video file in the ring
+            video_filename = os.path.join(VIDEO_STORAGE_DIR, f"video_{self.next_slot:02d}.mp4")
             logging.info(f"Starting new recording file: {video_filename}")
-            video_writer = cv2.VideoWriter(video_filename, fourcc, FPS, (FRAME_WIDTH, FRAME_HEIGHT))
-            end_time = time.time() + VIDEO_DURATION
+            self.video_writer = cv2.VideoWriter(video_filename, self.fourcc, FPS, (FRAME_WIDTH, FRAME_HEIGHT))
+            self.next_slot = (self.next_slot + 1) % VIDEO_SLOTS
+            self.end_time = time.monotonic() + VIDEO_DURATION
 
-        video_writer.write(frame)
+        self.video_writer.write(frame)
 
         # Time to start a new chunk?
-        if time.time() >= end_time:
+        if time.monotonic() >= self.end_time:
             logging.info("Reached end of video chunk duration. Closing file and starting new one.")
-            video_writer.release()
-            video_writer = None
+            self.release()
 
-        # Manage old files periodically to reduce overhead
-        if int(time.time()) % 300 == 0:  # Every 5 minutes
-            manage_storage()
+    def release(self):
+        """
+        Close the current video file, if any.
+        """
+        if self.video_writer is not None:
+            self.video_writer.release()
+            self.video_writer = None
 
-        time.sleep(1 / FPS)
+###############################################################################
+# Background Subtraction
+###############################################################################
+class BackgroundSubtractor:
+    """
+    MOG2 background subtractor that runs on a CUDA GPU when OpenCV was built with
+    CUDA support and a device is present, and falls back to the CPU otherwise.
+    """
+    def __init__(self, history=500, var_threshold=VAR_THRESHOLD, detect_shadows=True):
+        self._gpu_frame = None
+        if USE_CUDA:
+            try:
+                if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+                    self._backSub = cv2.cuda.createBackgroundSubtractorMOG2(
+                        history=history, varThreshold=var_threshold, detectShadows=detect_shadows)
+                    self._gpu_frame = cv2.cuda_GpuMat()
+                    self._stream = cv2.cuda.Stream_Null()
+                    logging.info("Using CUDA background subtraction.")
+                    return
+            except (AttributeError, cv2.error) as e:
+                logging.warning(f"CUDA background subtraction unavailable, using CPU: {e}")
+
+        self._backSub = cv2.createBackgroundSubtractorMOG2(
+            history=history, varThreshold=var_threshold, detectShadows=detect_shadows)
+
+    def apply(self, frame):
+        """
+        Update the background model with `frame` and return the foreground mask.
+        """
+        if self._gpu_frame is not None:
+            self._gpu_frame.upload(frame)
+            return self._backSub.apply(self._gpu_frame, -1.0, self._stream).download()
+        return self._backSub.apply(frame)
 
 ###############################################################################
-# Anomaly Detection Thread
+# Anomaly Detector
 ###############################################################################
-def detect_anomalies():
+class AnomalyDetector:
     """
     Uses background subtraction to detect large motion anomalies in the shared camera feed.
     Saves JPEG photos on detection but then waits 5 seconds (ANOMALY_COOLDOWN) before taking
     another anomaly photo to prevent spam.
     """
-    logging.info("Anomaly detection thread started.")
+    def __init__(self):
+        self.backSub = BackgroundSubtractor(history=500, var_threshold=VAR_THRESHOLD, detect_shadows=True)
+        self.last_capture_time = 0  # track last anomaly capture
 
-    backSub = cv2.createBackgroundSubtractorMOG2(history=500, varThreshold=VAR_THRESHOLD, detectShadows=True)
-    last_capture_time = 0  # track last anomaly capture
+        # Motion detection runs on a downscaled frame, so scale the area threshold to match
+        self.detection_size = (FRAME_WIDTH // DETECTION_SCALE, FRAME_HEIGHT // DETECTION_SCALE)
+        self.area_threshold = CONTOUR_AREA_THRESHOLD // (DETECTION_SCALE * DETECTION_SCALE)
 
-    while True:
-        frame = camera.get_frame()
-        if frame is None:
-            logging.debug("No frame available for anomaly detection.")
-            time.sleep(0.05)
-            continue
-
-        # Apply background subtraction
-        fgMask = backSub.apply(frame)
+    def process(self, frame):
+        """
+        Run motion detection on a frame and save it if an anomaly is found.
+        """
+        # Apply background subtraction on a downscaled copy
+        small = cv2.resize(frame, self.detection_size, interpolation=cv2.INTER_AREA)
+        fgMask = self.backSub.apply(small)
 
         # Threshold the mask to remove shadows (gray areas)
         _, thresh = cv2.threshold(fgMask, 250, 255, cv2.THRESH_BINARY)
 
-        # Find contours
+        # Find outer contours; contourArea covers the whole region inside each outline,
+        # so hollow foreground masks of uniformly coloured objects still count in full
         contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        anomaly_detected = False
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            if area > CONTOUR_AREA_THRESHOLD:
-                anomaly_detected = True
-                break
+        anomaly_detected = any(cv2.contourArea(contour) > self.area_threshold for contour in contours)
 
         # If an anomaly is detected, check cooldown
         if anomaly_detected:
             now = time.time()
-            if now - last_capture_time >= ANOMALY_COOLDOWN:
+            if now - self.last_capture_time >= ANOMALY_COOLDOWN:
                 # Save anomaly image
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                anomaly_filename = f"anomaly_{timestamp}.jpg"
-                anomaly_filepath = os.path.join(ANOMALY_STORAGE_DIR, anomaly_filename)
-                cv2.imwrite(anomaly_filepath, frame)
+                anomaly_filepath = save_anomaly(frame, now)
                 logging.info(f"Anomaly detected! Photo saved: {anomaly_filepath}")
-                last_capture_time = now
+                self.last_capture_time = now
             else:
                 logging.debug("Anomaly detected but still in cooldown.")
 
-        # Manage storage periodically to reduce overhead
-        if int(time.time()) % 60 == 0:  # Every minute
-            manage_storage()
-
-        time.sleep(0.1)
-
 ###############################################################################
 # Main Entry Point
 ###############################################################################
@@ -497,15 +660,14 @@ if __name__ == '__main__':
     os.makedirs(VIDEO_STORAGE_DIR, exist_ok=True)
     os.makedirs(ANOMALY_STORAGE_DIR, exist_ok=True)
 
-    # Start recording in a separate thread
-    recording_thread = threading.Thread(target=record_video, daemon=True)
-    recording_thread.start()
-    logging.info("Recording thread initialized.")
+    # Record and detect anomalies in the camera's capture thread
+    recorder = VideoRecorder()
+    camera.add_frame_handler(recorder.write)
+    logging.info("Video recorder initialized.")
 
-    # Start anomaly detection in a separate thread
-    anomaly_thread = threading.Thread(target=detect_anomalies, daemon=True)
-    anomaly_thread.start()
-    logging.info("Anomaly detection thread initialized.")
+    detector = AnomalyDetector()
+    camera.add_frame_handler(detector.process)
+    logging.info("Anomaly detector initialized.")
 
     # Run Flask app to serve the default page, camera page, and MJPEG feed
     logging.info("Starting Flask server on port 5000...")
@@ -513,4 +675,5 @@ if __name__ == '__main__':
 
     # When the Flask server exits, we can stop the camera if desired
     camera.stop()
+    recorder.release()
     logging.info("EcoNest Security Camera script shutting down.")
\ No newline at end of file